@@ -1,29 +1,99 @@
 from flask import Flask, render_template, request, jsonify
+from flask.json.provider import JSONProvider
+from flask_compress import Compress
+import orjson
+from cachetools import TTLCache
 import random
 import requests
-from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
 from datetime import date
+from collections import Counter, deque
 import uuid
+import secrets
+import threading
+import os
+import shelve
+import queue
+import time
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (compact, Rust-native encoding)."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype="application/json",
+        )
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Compress JSON/HTML on the wire (card lists repeat long sprite URLs)
+app.config["COMPRESS_ALGORITHM"] = ["br", "gzip"]
+app.config["COMPRESS_MIN_SIZE"] = 512
+Compress(app)
+
+# In-memory game storage: bounded LRU with idle expiry (TTLCache is not thread-safe)
+GAME_TTL_SECONDS = 3600
+MAX_GAMES = 10_000
+games = TTLCache(maxsize=MAX_GAMES, ttl=GAME_TTL_SECONDS)
+_games_lock = threading.Lock()
+
+
+def get_game(game_id):
+    """Look up a live game and refresh its expiry; None if unknown or expired."""
+    with _games_lock:
+        game = games.get(game_id)
+        if game is not None:
+            games[game_id] = game  # re-insert resets the TTL and LRU position
+        return game
 
-# In-memory game storage
-games = {}
+
+def save_game(game):
+    with _games_lock:
+        games[game.id] = game
 
 # Shared HTTP session
 session = requests.Session()
-session.headers.update({"User-Agent": "AI-Memory-Game/1.0 (+https://localhost)"})
+session.headers.update({
+    "User-Agent": "AI-Memory-Game/1.0 (+https://localhost)",
+    "Connection": "keep-alive",
+})
+# PokéAPI (https): large keep-alive pool for concurrent prefetch, retry transient 5xx.
+# Ollama (http, localhost): pooled but no retries, the circuit breaker handles outages.
+# Sized so every commentary worker plus inline callers (endgame, /roast) keep a live connection.
+OLLAMA_CONCURRENCY = 4
+session.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504]),
+))
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_CONCURRENCY * 2))
 
 
 # ---------- AI DIFFICULTY PROFILES ----------
 # epsilon = exploration rate (random move)
-# memory_window = how many recent moves to consider when refreshing memory
 DIFFICULTY_PROFILES = {
-    "easy":   {"epsilon": 0.50, "memory_window": 6},
-    "medium": {"epsilon": 0.20, "memory_window": 12},
-    "hard":   {"epsilon": 0.05, "memory_window": 999},  # effectively "all"
+    "easy":   {"epsilon": 0.50},
+    "medium": {"epsilon": 0.20},
+    "hard":   {"epsilon": 0.05},
 }
 
+# Per-game history bounds (older entries are dropped)
+MOVE_HISTORY_LIMIT = 256
+COMMENTARY_HISTORY_LIMIT = 50
+
 
 # ---------- THEME HELPERS ----------
 
@@ -35,6 +105,12 @@ EMOJI_POOL = [
     "🌞","🌙","⭐","☁️","🌈","❄️","🔥","💧","🌊","🌳","🌵","🌸"
 ]
 
+# Gen 1 ids used for Pokémon boards
+POKEMON_IDS = range(1, 151)
+POKEAPI_URL = "https://pokeapi.co/api/v2/pokemon/{}".format
+# Static sprite used when PokéAPI has no artwork (or is unreachable)
+SPRITE_URL = "https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{}.png".format
+
 FLAG_POOL = [
     "🇺🇸","🇬🇧","🇫🇷","🇩🇪","🇯🇵","🇨🇦","🇮🇹","🇪🇸","🇨🇳","🇧🇷",
     "🇷🇺","🇷🇴","🇸🇪","🇳🇴","🇫🇮","🇦🇺","🇳🇿","🇲🇽","🇮🇳","🇰🇷",
@@ -42,11 +118,60 @@ FLAG_POOL = [
 ]
 
 
-@lru_cache(maxsize=200)
-def get_pokemon_data(pokemon_id: int):
-    """Cached Pokémon fetch with robust sprite fallback."""
+# Two-level Pokémon cache: in-process dict, then a shelve file that survives restarts
+POKEDATA_PATH = os.path.join(os.path.expanduser("~"), ".cache", "pokemon-memory", "pokedata")
+POKEDATA_TTL_SECONDS = 30 * 86400  # after this, revalidate with a conditional GET
+POKEAPI_RETRY_SECONDS = 60  # fallbacks are not cached; skip refetching only this long
+_pokemon_cache = {}
+_pokemon_retry_at = {}  # pokemon_id -> monotonic time of next allowed fetch after a failure
+_pokemon_lock = threading.Lock()
+
+
+def _open_pokedata():
+    os.makedirs(os.path.dirname(POKEDATA_PATH), exist_ok=True)
+    return shelve.open(POKEDATA_PATH)
+
+
+def _read_pokedata(key):
+    """Best-effort read from the on-disk cache (None on miss or error)."""
+    with _pokemon_lock:
+        try:
+            with _open_pokedata() as db:
+                return db.get(key)
+        except Exception as e:
+            print(f"Pokédata cache read error: {e}")
+            return None
+
+
+def _write_pokedata(key, value):
+    """Best-effort write to the on-disk cache."""
+    with _pokemon_lock:
+        try:
+            with _open_pokedata() as db:
+                db[key] = value
+        except Exception as e:
+            print(f"Pokédata cache write error: {e}")
+
+
+def _fetch_pokemon(pokemon_id, entry=None):
+    """Fetch from PokéAPI, revalidating `entry` (a stored disk record) if given.
+
+    Stored records are {'data', 'etag', 'last_modified', 'fetched_at'}. A 304
+    or a network error with a stored record keeps serving the stored data;
+    with no record, a failure returns None.
+    """
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
     try:
-        r = session.get(f"https://pokeapi.co/api/v2/pokemon/{pokemon_id}", timeout=3)
+        r = session.get(POKEAPI_URL(pokemon_id), headers=headers, timeout=3)
+        if r.status_code == 304 and entry:
+            entry["fetched_at"] = time.time()
+            _write_pokedata(str(pokemon_id), entry)
+            return entry["data"]
         r.raise_for_status()
         data = r.json()
         sprites = data.get("sprites", {})
@@ -55,54 +180,225 @@ def get_pokemon_data(pokemon_id: int):
             .get("official-artwork", {})
             .get("front_default")
             or sprites.get("front_default")
-            or f"https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{pokemon_id}.png"
+            or SPRITE_URL(pokemon_id)
         )
-        return {
+        result = {
             "id": pokemon_id,
-            "name": data.get("name", f"pokemon-{pokemon_id}").capitalize(),
+            "name": (data.get("name") or f"pokemon-{pokemon_id}").capitalize(),
             "image": img,
         }
+        # only real API data is persisted
+        _write_pokedata(str(pokemon_id), {
+            "data": result,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        })
+        return result
     except Exception:
-        return {
-            "id": pokemon_id,
-            "name": f"Pokemon {pokemon_id}",
-            "image": f"https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{pokemon_id}.png",
-        }
+        if entry:
+            return entry["data"]  # stale-if-error
+        return None
+
+
+def _fallback_pokemon(pokemon_id):
+    return {
+        "id": pokemon_id,
+        "name": f"Pokemon {pokemon_id}",
+        "image": SPRITE_URL(pokemon_id),
+    }
+
+
+def get_pokemon_data(pokemon_id: int):
+    """Cached Pokémon fetch (memory, then disk, then PokéAPI) with robust sprite fallback."""
+    cached = _pokemon_cache.get(pokemon_id)
+    if cached is not None:
+        return cached
+    if time.monotonic() < _pokemon_retry_at.get(pokemon_id, 0.0):
+        return _fallback_pokemon(pokemon_id)
+
+    entry = _read_pokedata(str(pokemon_id))
+    if entry is not None and "data" not in entry:
+        entry = {"data": entry, "fetched_at": 0.0}  # pre-TTL record: revalidate
+    if entry is not None and time.time() - entry["fetched_at"] < POKEDATA_TTL_SECONDS:
+        result = entry["data"]
+    else:
+        result = _fetch_pokemon(pokemon_id, entry)
+
+    if result is None:
+        # Only real API/disk data is memoized; retry this id after a short pause
+        _pokemon_retry_at[pokemon_id] = time.monotonic() + POKEAPI_RETRY_SECONDS
+        return _fallback_pokemon(pokemon_id)
+    _pokemon_retry_at.pop(pokemon_id, None)
+    _pokemon_cache[pokemon_id] = result
+    return result
+
+
+# Pool for board-build fetches (I/O bound; requests releases the GIL). Warmup
+# uses its own daemon threads so a new board never queues behind the full Gen 1 list,
+# and so exit never waits for the rest of the list (executors drain their queue at exit).
+_pokemon_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="pokeapi")
+WARMUP_WORKERS = 4
 
 
 def get_pokemon_list(count=8, rng=None):
-    """Fast Pokémon list (Gen 1) using provided RNG (for seeding)."""
+    """Fast Pokémon list (Gen 1) using provided RNG (for seeding); misses fetch concurrently."""
     rng = rng or random
-    pokemon_ids = rng.sample(range(1, 151), count)
+    pokemon_ids = rng.sample(POKEMON_IDS, count)
+    missing = [pid for pid in pokemon_ids if pid not in _pokemon_cache]
+    if missing:
+        list(_pokemon_pool.map(get_pokemon_data, missing))
     return [get_pokemon_data(pid) for pid in pokemon_ids]
 
 
+def _warmup_worker(pending):
+    while True:
+        try:
+            pokemon_id = pending.get_nowait()
+        except queue.Empty:
+            return
+        get_pokemon_data(pokemon_id)
+
+
+def warm_pokemon_cache():
+    """Fetch every Gen 1 Pokémon once (in the background) so boards are built from cache."""
+    pending = queue.Queue()
+    for pokemon_id in POKEMON_IDS:
+        pending.put(pokemon_id)
+    for n in range(WARMUP_WORKERS):
+        threading.Thread(
+            target=_warmup_worker, args=(pending,), name=f"pokemon-warmup-{n}", daemon=True
+        ).start()
+
+
+# Circuit breaker: after a few consecutive failures, skip Ollama for a while
+OLLAMA_MAX_FAILURES = 3
+OLLAMA_COOLDOWN_SECONDS = 30
+_ollama_state = {"fail_count": 0, "open_until": 0.0}
+_ollama_lock = threading.Lock()
+
+FALLBACK_ROASTS = [
+    "Are you even trying? 😂",
+    "My grandmother could do better...",
+    "This is painful to watch.",
+    "Maybe memory games aren't your thing?"
+]
+
+
+@lru_cache(maxsize=512)
+def _ollama_generate(prompt: str):
+    """One Ollama generation, cached per prompt (failures raise, so they are never cached)."""
+    r = session.post(
+        "http://localhost:11434/api/generate",
+        json={"model": "llama3.2", "prompt": prompt, "stream": False},
+        timeout=3,
+    )
+    r.raise_for_status()
+    txt = r.json().get("response", "").strip()
+    if not txt:
+        raise RuntimeError("Empty Ollama response")
+    return txt
+
+
 def call_ollama(prompt: str):
-    """Call local Ollama for AI responses; fallback if unavailable."""
+    """Call local Ollama for AI responses; fallback if unavailable (or breaker open)."""
+    with _ollama_lock:
+        if time.monotonic() < _ollama_state["open_until"]:
+            return random.choice(FALLBACK_ROASTS)
     try:
-        r = session.post(
-            "http://localhost:11434/api/generate",
-            json={"model": "llama3.2", "prompt": prompt, "stream": False},
-            timeout=3,
-        )
-        r.raise_for_status()
-        txt = r.json().get("response", "").strip()
-        if txt:
-            return txt
-        raise RuntimeError("Empty Ollama response")
+        txt = _ollama_generate(prompt)
+        with _ollama_lock:
+            _ollama_state["fail_count"] = 0
+        return txt
     except Exception as e:
         print(f"Ollama error: {e}")
-        return random.choice([
-            "Are you even trying? 😂",
-            "My grandmother could do better...",
-            "This is painful to watch.",
-            "Maybe memory games aren't your thing?"
-        ])
+        with _ollama_lock:
+            _ollama_state["fail_count"] += 1
+            if _ollama_state["fail_count"] >= OLLAMA_MAX_FAILURES:
+                _ollama_state["open_until"] = time.monotonic() + OLLAMA_COOLDOWN_SECONDS
+                _ollama_state["fail_count"] = 0
+        return random.choice(FALLBACK_ROASTS)
+
+
+# Background commentary so /flip never waits on Ollama: prompts are queued, and a
+# dispatcher drains them in small batches (20ms linger) and fans each batch out
+# over a few keep-alive connections. Identical prompts in a batch share one call.
+COMMENTARY_BATCH_SIZE = 8
+COMMENTARY_LINGER_SECONDS = 0.02
+_commentary_queue = queue.Queue()
+_ollama_pool = ThreadPoolExecutor(max_workers=OLLAMA_CONCURRENCY, thread_name_prefix="ollama")
+
+
+def enqueue_commentary(game, prompt, kind, player):
+    """Queue a prompt; the result lands in game.commentary_history tagged with the current move."""
+    _commentary_queue.put((game, prompt, kind, player, game.moves))
+
+
+def _next_commentary_batch():
+    batch = [_commentary_queue.get()]
+    deadline = time.monotonic() + COMMENTARY_LINGER_SECONDS
+    while len(batch) < COMMENTARY_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_commentary_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _commentary_worker():
+    while True:
+        batch = _next_commentary_batch()
+        prompts = list(dict.fromkeys(item[1] for item in batch))
+        try:
+            results = _ollama_pool.map(call_ollama, prompts)
+        except RuntimeError:
+            return  # pool refused new work: interpreter is exiting
+        try:
+            texts = dict(zip(prompts, results))
+            for game, prompt, kind, player, move in batch:
+                if texts[prompt]:
+                    game._append_commentary(texts[prompt], kind, player, move)
+        except Exception as e:
+            print(f"Commentary worker error: {e}")
 
 
 # ---------- GAME ----------
 
+def _locked(method):
+    """Run a MemoryGame method while holding the game's lock."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class MemoryGame:
+    # Many games live in memory at once; slots avoid a per-instance __dict__
+    __slots__ = (
+        # setup
+        'id', 'difficulty', 'theme', 'seed', 'mode', 'opponent_is_ai', 'vs_human',
+        'pairs', 'time_attack', 'time_seconds',
+        # multiplayer
+        'player1_token', 'player2_token', 'player2_joined',
+        # board + derived views
+        'cards', '_by_id', '_by_pair_key', '_visible_cache', '_visible_by_id',
+        # game state
+        'moves', 'matches', 'player1_score', 'player2_score', 'current_flipped',
+        'move_history', 'flip_count', 'commentary_history', '_lock',
+        'mistakes_counter', 'last_mistake', 'current_player', 'commentary_frequency',
+        'prompt_count', 'state_version',
+        # opponent (vs_ai)
+        'opponent_difficulty', 'opponent_profile', 'opponent_memory', '_ai_rng',
+        '_available_ids', '_seen_ids', '_known_avail', '_face_up_unmatched',
+        # stats
+        'player1_attempts', 'player2_attempts', 'player1_pairs', 'player2_pairs',
+        'player1_streak', 'player2_streak', 'best_streak', 'player1_accuracy', 'player2_accuracy',
+    )
+
     def __init__(self, game_id, difficulty='medium', theme='pokemon', seed=None,
                  time_attack=False, time_seconds=0, mode='solo', opponent_difficulty='medium'):
         self.id = game_id
@@ -136,53 +432,73 @@ class MemoryGame:
         self.time_seconds = int(time_seconds) if self.time_attack else 0  # client drives countdown
 
         # Tokens and join status for multiplayer
-        self.player1_token = str(uuid.uuid4()) if mode != 'solo' else None
+        self.player1_token = uuid.uuid4().hex if mode != 'solo' else None
         self.player2_token = None
         self.player2_joined = mode != 'vs_human'  # True for solo/vs_ai, False for vs_human initially
 
         # Seeded RNG if provided
         rng = random.Random(seed) if seed is not None else random
 
-        # Build card pairs by theme
-        self.cards = []
+        # One (pair_key, name, image, emoji) payload per pair, by theme
         if theme == 'pokemon':
-            items = get_pokemon_list(self.pairs, rng=rng)
-            for i, it in enumerate(items):
-                self.cards.append(self._make_card(i * 2, it['id'], it['name'], image=it['image']))
-                self.cards.append(self._make_card(i * 2 + 1, it['id'], it['name'], image=it['image']))
+            payloads = [(it['id'], it['name'], it['image'], None)
+                        for it in get_pokemon_list(self.pairs, rng=rng)]
         elif theme == 'emoji':
-            pool = rng.sample(EMOJI_POOL, self.pairs)
-            for i, emo in enumerate(pool):
-                name = f"Emoji {emo}"
-                pair_id = 10_000 + i
-                self.cards.append(self._make_card(i * 2, pair_id, name, emoji=emo))
-                self.cards.append(self._make_card(i * 2 + 1, pair_id, name, emoji=emo))
+            payloads = [(10_000 + i, f"Emoji {emo}", None, emo)
+                        for i, emo in enumerate(rng.sample(EMOJI_POOL, self.pairs))]
         else:  # flags
-            pool = rng.sample(FLAG_POOL, self.pairs)
-            for i, flag in enumerate(pool):
-                name = f"Flag {flag}"
-                pair_id = 20_000 + i
-                self.cards.append(self._make_card(i * 2, pair_id, name, emoji=flag))
-                self.cards.append(self._make_card(i * 2 + 1, pair_id, name, emoji=flag))
+            payloads = [(20_000 + i, f"Flag {flag}", None, flag)
+                        for i, flag in enumerate(rng.sample(FLAG_POOL, self.pairs))]
+
+        self.cards = []
+        for i, (pair_key, name, image, emoji) in enumerate(payloads):
+            self.cards.extend(self._make_pair(i, pair_key, name, image=image, emoji=emoji))
 
         rng.shuffle(self.cards)
 
+        # Lookup indexes (cards are never re-ordered after the shuffle)
+        self._by_id = {c['id']: c for c in self.cards}
+        self._by_pair_key = {}
+        for c in self.cards:
+            self._by_pair_key.setdefault(c['pair_key'], []).append(c)
+
+        # Client-facing board view, patched in place as cards change
+        self._visible_cache = [{
+            'id': c['id'], 'flipped': False, 'matched': False,
+            'image': None, 'emoji': None, 'name': None
+        } for c in self.cards]
+        self._visible_by_id = {v['id']: v for v in self._visible_cache}
+
         # Game state
         self.moves = 0
         self.matches = 0
         self.player1_score = 0
         self.player2_score = 0
         self.current_flipped = []
-        self.move_history = []
-        self.commentary_history = []
-        self.mistakes = []
+        self.move_history = deque(maxlen=MOVE_HISTORY_LIMIT)
+        self.flip_count = 0
+        self.commentary_history = deque(maxlen=COMMENTARY_HISTORY_LIMIT)
+        # Guards all mutation: two players (or a player and the commentary worker) can hit one game
+        self._lock = threading.RLock()
+        self.mistakes_counter = Counter()  # "NameA-NameB" -> times missed
+        self.last_mistake = None
 
         # Opponent settings (for vs_ai)
         self.opponent_difficulty = opponent_difficulty if self.opponent_is_ai else None
         self.opponent_profile = DIFFICULTY_PROFILES.get(opponent_difficulty, DIFFICULTY_PROFILES['medium']) if self.opponent_is_ai else None
-        self.opponent_memory = {} if self.opponent_is_ai else None  # pair_key -> [card_ids seen]
+        self.opponent_memory = {} if self.opponent_is_ai else None  # pair_key -> {card_ids seen}
+        # AI's own RNG: seeded boards (daily) also get reproducible AI play
+        self._ai_rng = random.Random(f"{seed}-ai") if seed is not None else random.Random()
+
+        # Live sets for opponent move selection, kept in sync by flip_card/reset_unmatched
+        self._available_ids = {c['id'] for c in self.cards}  # face-down & unmatched
+        self._seen_ids = set()                                # every id the AI has seen
+        self._known_avail = {}                                # pair_key -> seen ids not yet matched
+        self._face_up_unmatched = set()                       # flipped, waiting for reset_unmatched
         self.current_player = 'player1'
         self.commentary_frequency = 3
+        self.prompt_count = 0  # drives _pick_variant; independent of when commentary fires
+        self.state_version = 0  # bumped on every change visible via /state (ETag)
 
         # Stats: combo streaks & accuracy
         self.player1_attempts = 0
@@ -192,10 +508,12 @@ class MemoryGame:
         self.player1_streak = 0
         self.player2_streak = 0
         self.best_streak = 0
+        self.player1_accuracy = 0.0  # kept current by _update_accuracy
+        self.player2_accuracy = 0.0
 
-    def _make_card(self, cid, pair_key, name, image=None, emoji=None):
-        return {
-            'id': cid,
+    def _make_pair(self, index, pair_key, name, image=None, emoji=None):
+        """Both cards of pair `index` (ids index*2 and index*2+1) from one template."""
+        tmpl = {
             'pair_key': pair_key,
             'name': name,
             'image': image,   # URL or None
@@ -203,20 +521,28 @@ class MemoryGame:
             'flipped': False,
             'matched': False
         }
+        return [{'id': index * 2, **tmpl}, {'id': index * 2 + 1, **tmpl}]
 
     def visible_cards(self):
-        """Only reveal media for flipped/matched cards."""
-        return [{
-            'id': c['id'],
-            'flipped': c['flipped'],
-            'matched': c['matched'],
-            'image': c['image'] if c['flipped'] or c['matched'] else None,
-            'emoji': c['emoji'] if c['flipped'] or c['matched'] else None,
-            'name': c['name'] if c['flipped'] or c['matched'] else None
-        } for c in self.cards]
+        """Only reveal media for flipped/matched cards (cached view, do not mutate)."""
+        return self._visible_cache
+
+    def _visible_for(self, *cards):
+        """Visible entries for just the given cards (flip deltas)."""
+        return [self._visible_by_id[c['id']] for c in cards]
+
+    def _sync_visible(self, card):
+        """Patch the cached visible entry for a card after its state changed."""
+        v = self._visible_by_id[card['id']]
+        shown = card['flipped'] or card['matched']
+        v['flipped'] = card['flipped']
+        v['matched'] = card['matched']
+        v['image'] = card['image'] if shown else None
+        v['emoji'] = card['emoji'] if shown else None
+        v['name'] = card['name'] if shown else None
 
     def preview_cards(self):
-        """Reveal everything for preview (client may ignore)."""
+        """Reveal everything for preview (only sent when the client asks)."""
         return [{
             'id': c['id'],
             'flipped': c['flipped'],
@@ -228,16 +554,33 @@ class MemoryGame:
 
     def _stats_fragment(self):
         """Stats snippet to include in API responses."""
-        pa1 = round((self.player1_pairs / self.player1_attempts) * 100, 1) if self.player1_attempts else 0.0
-        pa2 = round((self.player2_pairs / self.player2_attempts) * 100, 1) if self.player2_attempts else 0.0
         return {
-            'player1_accuracy': pa1,
-            'player2_accuracy': pa2,
+            'player1_accuracy': self.player1_accuracy,
+            'player2_accuracy': self.player2_accuracy,
             'best_streak': self.best_streak
         }
 
+    def _update_accuracy(self, player):
+        """Recompute one player's accuracy after their attempts/pairs changed."""
+        if player == 'player1':
+            self.player1_accuracy = round((self.player1_pairs / self.player1_attempts) * 100, 1)
+        else:
+            self.player2_accuracy = round((self.player2_pairs / self.player2_attempts) * 100, 1)
+
     def flip_card(self, card_id, player='player1', token=None):
         """Flip a card and check for matches."""
+        payload = self._flip_card(card_id, player, token)
+        prompt = payload.pop('endgame_prompt', None)
+        if prompt:
+            # Kept inline (clients stop polling once the winning flip returns),
+            # but outside the lock so the other player's /state isn't held up
+            payload['commentary'] = call_ollama(prompt)
+            if payload['commentary']:
+                self._append_commentary(payload['commentary'], 'match', player, payload['moves'])
+        return payload
+
+    @_locked
+    def _flip_card(self, card_id, player, token):
         # Token validation
         if self.mode != 'solo':
             if self.opponent_is_ai and player == 'player2':
@@ -255,27 +598,32 @@ class MemoryGame:
         if player != self.current_player:
             return {'success': False, 'message': 'Not your turn'}
 
-        card = next((c for c in self.cards if c['id'] == card_id), None)
+        card = self._by_id.get(card_id) if isinstance(card_id, int) else None
         if not card or card['matched'] or card['flipped']:
             return {'success': False, 'message': 'Invalid card'}
 
         card['flipped'] = True
+        self.state_version += 1
+        self._sync_visible(card)
+        self._available_ids.discard(card_id)
+        self._face_up_unmatched.add(card_id)
         self.current_flipped.append(card)
 
         # Record move
+        self.flip_count += 1
         self.move_history.append({
             'card_id': card_id,
             'pair_key': card['pair_key'],
             'name': card['name'],
-            'move_number': len(self.move_history) + 1,
+            'move_number': self.flip_count,
             'player': player
         })
 
         # Track opponent memory if AI
         if self.opponent_is_ai:
-            mem = self.opponent_memory.setdefault(card['pair_key'], [])
-            if card_id not in mem:
-                mem.append(card_id)
+            self.opponent_memory.setdefault(card['pair_key'], set()).add(card_id)
+            self._seen_ids.add(card_id)
+            self._known_avail.setdefault(card['pair_key'], set()).add(card_id)
 
         # If two cards are face up, resolve
         if len(self.current_flipped) == 2:
@@ -291,6 +639,11 @@ class MemoryGame:
                 # MATCH
                 card1['matched'] = True
                 card2['matched'] = True
+                self._sync_visible(card1)
+                self._sync_visible(card2)
+                self._known_avail.pop(card1['pair_key'], None)
+                self._face_up_unmatched.discard(card1['id'])
+                self._face_up_unmatched.discard(card2['id'])
                 self.matches += 1
 
                 if player == 'player1':
@@ -298,13 +651,18 @@ class MemoryGame:
                     self.player1_streak += 1
                     bonus = max(0, self.player1_streak - 1)  # 0,1,2...
                     self.player1_score += 1 + bonus
+                    streak = self.player1_streak
                 else:
                     self.player2_pairs += 1
                     self.player2_streak += 1
                     bonus = max(0, self.player2_streak - 1)
                     self.player2_score += 1 + bonus
+                    streak = self.player2_streak
 
-                self.best_streak = max(self.best_streak, self.player1_streak, self.player2_streak)
+                self._update_accuracy(player)
+                # Only the scoring player's streak moved
+                if streak > self.best_streak:
+                    self.best_streak = streak
                 self.current_flipped = []
 
                 # ALWAYS alternate after resolving a pair in non-solo modes
@@ -312,20 +670,18 @@ class MemoryGame:
                     self.current_player = 'player2' if player == 'player1' else 'player1'
 
                 commentary = ""
+                endgame_prompt = None
                 # FIX: endgame commentary respects actual winner in AI mode
                 if self.matches == self.pairs:
-                    commentary = self.get_endgame_commentary(player)
+                    endgame_prompt = self.endgame_commentary_prompt(player)
                 elif self.matches % self.commentary_frequency == 0:
-                    commentary = self.get_match_commentary(player)
-                if commentary:
-                    self.commentary_history.append({
-                        'text': commentary, 'type': 'match', 'player': player, 'move': self.moves
-                    })
+                    enqueue_commentary(self, self.match_commentary_prompt(player), 'match', player)
 
                 payload = {
                     'success': True,
                     'match': True,
                     'cards': [card1, card2],
+                    'changed_cards': self._visible_for(card1, card2),
                     'moves': self.moves,
                     'matches': self.matches,
                     'player1_score': self.player1_score,
@@ -334,6 +690,7 @@ class MemoryGame:
                     'commentary': commentary,
                     'player': player,
                     'current_player': self.current_player,  # include turn info
+                    'endgame_prompt': endgame_prompt,  # popped by flip_card
                 }
                 payload.update(self._stats_fragment())
                 return payload
@@ -341,11 +698,13 @@ class MemoryGame:
             else:
                 # MISS
                 mistake = f"{card1['name']}-{card2['name']}"
-                self.mistakes.append(mistake)
+                self.mistakes_counter[mistake] += 1
+                self.last_mistake = mistake
                 if player == 'player1':
                     self.player1_streak = 0
                 else:
                     self.player2_streak = 0
+                self._update_accuracy(player)
 
                 # Alternate to the other player in non-solo modes
                 if self.mode != 'solo':
@@ -353,16 +712,13 @@ class MemoryGame:
 
                 commentary = ""
                 if self.moves % self.commentary_frequency == 0:
-                    commentary = self.get_miss_commentary(player)
-                    if commentary:
-                        self.commentary_history.append({
-                            'text': commentary, 'type': 'miss', 'player': player, 'move': self.moves
-                        })
+                    enqueue_commentary(self, self.miss_commentary_prompt(player), 'miss', player)
 
                 payload = {
                     'success': True,
                     'match': False,
                     'cards': [card1, card2],
+                    'changed_cards': self._visible_for(card1, card2),
                     'moves': self.moves,
                     'player1_score': self.player1_score,
                     'player2_score': self.player2_score,
@@ -378,17 +734,23 @@ class MemoryGame:
         return {
             'success': True,
             'card': card,
+            'changed_cards': self._visible_for(card),
             'player': player,
             'player1_score': self.player1_score,
             'player2_score': self.player2_score
         }
 
+    @_locked
     def reset_unmatched(self):
-        """Turn all unmatched cards face-down."""
-        for card in self.cards:
-            if not card['matched']:
-                card['flipped'] = False
+        """Turn all unmatched face-up cards face-down (only the tracked ones are touched)."""
+        for cid in self._face_up_unmatched:
+            card = self._by_id[cid]
+            card['flipped'] = False
+            self._sync_visible(card)
+            self._available_ids.add(cid)
+        self._face_up_unmatched.clear()
         self.current_flipped = []
+        self.state_version += 1
 
     def get_player_name(self, player):
         if player == 'player1':
@@ -396,19 +758,44 @@ class MemoryGame:
         else:
             return "AI" if self.opponent_is_ai else "Player 2"
 
-    def get_match_commentary(self, player):
-        """AI commentary for a mid-game match (non-final)."""
+    def _pick_variant(self, variants):
+        """Rotate through a small fixed prompt set: varied per game, but cache-friendly across games."""
+        self.prompt_count += 1
+        return variants[(hash(self.id) + self.prompt_count) % len(variants)]
+
+    def match_commentary_prompt(self, player):
+        """Prompt for a mid-game match (non-final)."""
         player_name = self.get_player_name(player)
         optimal_moves = self.pairs
         efficiency = (optimal_moves / max(self.moves, 1)) * 100
         if efficiency > 80:
-            prompt = f"{player_name} doing very well. Short competitive response (1 sentence)."
+            prompt = self._pick_variant([
+                f"{player_name} doing very well. Short competitive response (1 sentence).",
+                f"{player_name} is on a roll. Short competitive trash talk (1 sentence).",
+                f"{player_name} keeps finding pairs. Short grudging respect (1 sentence).",
+            ])
         else:
-            prompt = f"{player_name} made a match but still has room to improve. Playful jab (1 sentence)."
-        return call_ollama(prompt)
-
-    def get_endgame_commentary(self, player):
-        """AI commentary when the board is cleared; respects actual winner."""
+            prompt = self._pick_variant([
+                f"{player_name} made a match but still has room to improve. Playful jab (1 sentence).",
+                f"{player_name} finally found a pair. Playful backhanded compliment (1 sentence).",
+                f"{player_name} got a match, barely. Light teasing (1 sentence).",
+            ])
+        return prompt
+
+    def _append_commentary(self, text, kind, player, move):
+        with self._lock:
+            self.commentary_history.append({
+                'text': text, 'type': kind, 'player': player, 'move': move
+            })
+            self.state_version += 1
+
+    def recent_commentary(self, n=5):
+        """Last n commentary entries as a list (copied under the lock)."""
+        with self._lock:
+            return list(self.commentary_history)[-n:]
+
+    def endgame_commentary_prompt(self, player):
+        """Prompt for when the board is cleared; respects actual winner."""
         p1 = self.player1_score
         p2 = self.player2_score
         if self.mode == 'solo':
@@ -431,20 +818,23 @@ class MemoryGame:
                 prompt = f"Game over: Player 2 beat Player 1 {p2} to {p1}. Brief congrats to Player 2 (1 sentence)."
             else:
                 prompt = f"Game over: Tie at {p1} each. Short playful tie remark (1 sentence)."
-        return call_ollama(prompt)
+        return prompt
 
-    def get_miss_commentary(self, player):
-        """AI commentary for a miss."""
+    def miss_commentary_prompt(self, player):
+        """Prompt for a miss."""
         player_name = self.get_player_name(player)
-        last_mistake = self.mistakes[-1] if self.mistakes else None
-        repeated = self.mistakes.count(last_mistake) if last_mistake else 0
+        repeated = self.mistakes_counter[self.last_mistake] if self.last_mistake else 0
         if repeated >= 3:
             prompt = f"{player_name} flipped the same wrong pair {repeated} times. Funny roast (1 sentence)."
         elif self.moves >= self.pairs * 2:
             prompt = f"{player_name} at {self.moves} moves for {self.pairs} pairs. Sarcastic comment (1 sentence)."
         else:
-            prompt = f"{player_name} missed. Short sassy comment (1 sentence)."
-        return call_ollama(prompt)
+            prompt = self._pick_variant([
+                f"{player_name} missed. Short sassy comment (1 sentence).",
+                f"{player_name} flipped the wrong pair. Short cheeky remark (1 sentence).",
+                f"{player_name} guessed wrong. Short witty jab (1 sentence).",
+            ])
+        return prompt
 
     def get_performance_roast(self, player='player1'):
         """Roast about overall performance."""
@@ -460,11 +850,12 @@ class MemoryGame:
             prompt = f"{player_name} doing well - {current} moves, {self.matches}/{self.pairs} pairs. Competitive response (1 sentence)."
         return call_ollama(prompt)
 
+    @_locked
     def get_opponent_move(self):
         """
         AI chooses a card to flip using a difficulty profile:
           - epsilon: exploration rate (random move)
-          - memory_window: how far back we refresh memory from history
+        Memory is recorded by flip_card as cards are revealed (both players).
         Strategy priority:
           1) If mate of current face-up card is known -> choose it.
           2) If any complete known pair exists -> choose one of them.
@@ -473,63 +864,58 @@ class MemoryGame:
         """
         if not self.opponent_is_ai:
             return None
-        profile = self.opponent_profile
-        epsilon = profile["epsilon"]
-        window = profile["memory_window"]
-
-        # Refresh memory from recent moves
-        recent = self.move_history[-window:] if window < 999 else self.move_history
-        for move in recent:
-            pk = move['pair_key']; cid = move['card_id']
-            self.opponent_memory.setdefault(pk, [])
-            if cid not in self.opponent_memory[pk]:
-                self.opponent_memory[pk].append(cid)
-
-        # Available = unmatched & face-down
-        available = [c for c in self.cards if not c['matched'] and not c['flipped']]
+        epsilon = self.opponent_profile["epsilon"]
+
+        # Available = unmatched & face-down (live set maintained by flip/reset)
+        available = self._available_ids
         if not available:
             return None
 
-        # Helper: known positions per pair, filtered to those still available
+        # Known positions per pair, filtered to those still available
         known_positions = {}
-        for pk, ids in self.opponent_memory.items():
-            avail_ids = [cid for cid in ids if any(c['id'] == cid and not c['matched'] and not c['flipped'] for c in self.cards)]
+        for pk, ids in self._known_avail.items():
+            avail_ids = ids & available
             if avail_ids:
                 known_positions[pk] = avail_ids
 
         # 1) If one card is face up now, try to pick its mate if known
         if self.current_flipped:
             first = self.current_flipped[0]
-            pk = first['pair_key']
-            if pk in known_positions:
-                for cid in known_positions[pk]:
-                    if cid != first['id']:
-                        if any(c['id'] == cid for c in available):
-                            return cid
+            for cid in known_positions.get(first['pair_key'], ()):
+                if cid != first['id']:
+                    return cid
 
         # 2) If any complete known pair exists (two available positions), take one
-        for pk, ids in known_positions.items():
-            ids_avail = [cid for cid in ids if any(c['id'] == cid for c in available)]
-            if len(set(ids_avail)) >= 2:
-                return ids_avail[0]
+        for ids in known_positions.values():
+            if len(ids) >= 2:
+                return min(ids)
 
         # 3) Exploration vs exploitation with epsilon
-        import random as _r
-        if _r.random() < epsilon:
-            return _r.choice(available)['id']
+        rng = self._ai_rng
+        if rng.random() < epsilon:
+            return rng.choice(sorted(available))
 
         # Prefer unknown positions (ids never seen)
-        seen_ids = set(cid for id_list in self.opponent_memory.values() for cid in id_list)
-        unknown_positions = [c for c in available if c['id'] not in seen_ids]
+        unknown_positions = available - self._seen_ids
         if unknown_positions:
-            return _r.choice(unknown_positions)['id']
+            return rng.choice(sorted(unknown_positions))
 
         # 4) Otherwise, pick any available (all known)
-        return _r.choice(available)['id']
+        return rng.choice(sorted(available))
+
+
+# Background threads; started at import so they run under gunicorn as well as `python app.py`
+warm_pokemon_cache()
+threading.Thread(target=_commentary_worker, name="commentary-worker", daemon=True).start()
 
 
 # ---------- ROUTES ----------
 
+def _wants_preview(data):
+    """Full reveal is opt-in ({"preview": true} or ?preview=1); it roughly doubles the payload."""
+    return bool(data.get('preview')) or request.args.get('preview') in ('1', 'true')
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -538,7 +924,7 @@ def index():
 @app.route('/api/game/new', methods=['POST'])
 def new_game():
     data = request.json or {}
-    game_id = str(random.randint(100000, 999999))
+    game_id = secrets.token_urlsafe(9)
     difficulty = data.get('difficulty', 'medium')
     theme = data.get('theme', 'pokemon')
     multiplayer = data.get('multiplayer', False)
@@ -561,14 +947,13 @@ def new_game():
         time_attack=time_attack, time_seconds=time_seconds,
         mode=mode, opponent_difficulty=ai_difficulty
     )
-    games[game_id] = game
+    save_game(game)
 
     resp = {
         'game_id': game_id,
         'player_token': game.player1_token if mode != 'solo' else None,
         'is_host': True,
         'cards': game.visible_cards(),
-        'preview_cards': game.preview_cards(),  # client may ignore
         'pairs': game.pairs,
         'theme': theme,
         'mode': game.mode,
@@ -584,26 +969,29 @@ def new_game():
         'player2_joined': game.player2_joined,
         'current_player': game.current_player
     }
+    if _wants_preview(data):
+        resp['preview_cards'] = game.preview_cards()
     return jsonify(resp)
 
 
 @app.route('/api/game/<game_id>/join', methods=['POST'])
 def join_game(game_id):
-    if game_id not in games:
+    data = request.get_json(silent=True) or {}
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
-    if game.mode != 'vs_human' or game.player2_joined:
-        return jsonify({'error': 'Cannot join this game'}), 400
-
-    game.player2_token = str(uuid.uuid4())
-    game.player2_joined = True
+    with game._lock:
+        if game.mode != 'vs_human' or game.player2_joined:
+            return jsonify({'error': 'Cannot join this game'}), 400
+        game.player2_token = uuid.uuid4().hex
+        game.player2_joined = True
+        game.state_version += 1
 
     resp = {
         'game_id': game_id,
         'player_token': game.player2_token,
         'is_host': False,
         'cards': game.visible_cards(),
-        'preview_cards': game.preview_cards(),
         'pairs': game.pairs,
         'theme': game.theme,
         'mode': game.mode,
@@ -619,14 +1007,16 @@ def join_game(game_id):
         'player2_joined': game.player2_joined,
         'current_player': game.current_player
     }
+    if _wants_preview(data):
+        resp['preview_cards'] = game.preview_cards()
     return jsonify(resp)
 
 
 @app.route('/api/game/<game_id>/state', methods=['GET'])
 def get_game_state(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     token = request.args.get('player_token')
     if game.mode != 'solo':
         is_player1 = token == game.player1_token
@@ -634,7 +1024,20 @@ def get_game_state(game_id):
         if not (is_player1 or is_player2):
             return jsonify({'success': False, 'message': 'Invalid token'}), 403
 
-    return jsonify({
+    # Pollers revalidate with If-None-Match; unchanged games skip building the body.
+    # Weak validator: flask-compress leaves weak ETags alone across encodings.
+    etag = f"{game.id}-{game.state_version}"
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(_game_state_payload(game))
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
+def _game_state_payload(game):
+    return {
         'success': True,
         'cards_state': game.visible_cards(),
         'moves': game.moves,
@@ -643,56 +1046,60 @@ def get_game_state(game_id):
         'player2_score': game.player2_score,
         'current_player': game.current_player,
         'game_won': game.matches == game.pairs,
-        'commentary_history': game.commentary_history[-5:],
+        'commentary_history': game.recent_commentary(),
         'player2_joined': game.player2_joined,
         **game._stats_fragment()
-    })
+    }
 
 
 @app.route('/api/game/<game_id>/flip', methods=['POST'])
 def flip_card(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-
-    game = games[game_id]
     data = request.json or {}
     card_id = data.get('card_id')
     player = data.get('player', 'player1')
     token = data.get('player_token')
 
+    # Only the cards that changed are sent back; /state serves a full resync
     result = game.flip_card(card_id, player, token)
-    result['cards_state'] = game.visible_cards()
-    result['commentary_history'] = game.commentary_history[-5:]
+    result['commentary_history'] = game.recent_commentary()
     return jsonify(result)
 
 
 @app.route('/api/game/<game_id>/reset', methods=['POST'])
 def reset_cards(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     game.reset_unmatched()
-    return jsonify({'cards': game.visible_cards()})
+    return jsonify({
+        'cards': game.visible_cards(),
+        'commentary_history': game.recent_commentary()
+    })
 
 
 @app.route('/api/game/<game_id>/time-bonus', methods=['POST'])
 def apply_time_bonus(game_id):
     """Apply a small time bonus to player's score (1 point per 10s left)."""
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     data = request.json or {}
     seconds_left = max(0, int(data.get('seconds_left', 0)))
     bonus = seconds_left // 10
-    game.player1_score += bonus
+    with game._lock:
+        game.player1_score += bonus
+        game.state_version += 1
     return jsonify({'bonus': bonus, 'player1_score': game.player1_score})
 
 
 @app.route('/api/game/<game_id>/roast', methods=['GET'])
 def get_roast(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     player = request.args.get('player', 'player1')
     roast = game.get_performance_roast(player)
     return jsonify({'roast': roast})
@@ -700,9 +1107,9 @@ def get_roast(game_id):
 
 @app.route('/api/game/<game_id>/opponent-move', methods=['GET'])
 def opponent_move(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     card_id = game.get_opponent_move()
     if card_id is None:
         return jsonify({'error': 'No valid moves'}), 400
@@ -711,28 +1118,30 @@ def opponent_move(game_id):
 
 @app.route('/api/game/<game_id>/history', methods=['GET'])
 def get_history(game_id):
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     return jsonify({
-        'move_history': game.move_history[-20:],
-        'commentary_history': game.commentary_history
+        'move_history': list(game.move_history)[-20:],
+        'commentary_history': game.recent_commentary(COMMENTARY_HISTORY_LIMIT)
     })
 
 
 @app.route('/api/game/<game_id>/opponent-memory', methods=['GET'])
 def opponent_memory(game_id):
     """Expose a tiny view of opponent's memory for the HUD (AI only)."""
-    if game_id not in games:
+    game = get_game(game_id)
+    if game is None:
         return jsonify({'error': 'Game not found'}), 404
-    game = games[game_id]
     if not game.opponent_is_ai:
         return jsonify({'error': 'Not available'}), 400
+    with game._lock:
+        seen = [(pk, len(ids)) for pk, ids in game.opponent_memory.items()]
     memory = []
-    for pk, ids in game.opponent_memory.items():
-        name = next((c['name'] for c in game.cards if c['pair_key'] == pk), f"#{pk}")
-        # count only currently known unique ids
-        memory.append({"pair_key": pk, "name": name, "seen": len(set(ids))})
+    for pk, count in seen:
+        cards = game._by_pair_key.get(pk)
+        name = cards[0]['name'] if cards else f"#{pk}"
+        memory.append({"pair_key": pk, "name": name, "seen": count})
     memory.sort(key=lambda x: -x["seen"])
     return jsonify({"memory": memory[:8]})
 
@@ -747,4 +1156,5 @@ if __name__ == '__main__':
     print("=" * 50)
     print("🌐 Open: http://localhost:5000")
     print("=" * 50)
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Dev server only; production runs under gunicorn (see Procfile / wsgi.py)
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,4 @@
+"""WSGI entrypoint: `gunicorn wsgi:app` (see Procfile)."""
+from app import app
+
+__all__ = ["app"]